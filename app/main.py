@@ -2,8 +2,10 @@ from fastapi import FastAPI
 from pydantic import BaseModel
 from typing import List, Optional, Tuple, Dict, Any
 import re
-import json
-from datetime import datetime
+import asyncio
+from dataclasses import dataclass
+from datetime import date
+from functools import lru_cache
 
 app = FastAPI(
     title="MM-IM Remediator (S4HANA Material Document & Stock Tables)"
@@ -85,20 +87,79 @@ HISTORY_MAP: Dict[str, Dict[str, Any]] = {
 }
 
 # Merge all tables into one map for detection
-TABLE_MAP = {**CORE_DOC_MAP, **HYBRID_MAP, **AGGR_MAP, **DIMP_MAP, **HISTORY_MAP}
+TABLE_MAP: Dict[str, Dict[str, Any]] = {**CORE_DOC_MAP, **HYBRID_MAP, **AGGR_MAP, **DIMP_MAP, **HISTORY_MAP}
 
 # -----------------------------
 # Regex
 # -----------------------------
 
-TABLE_NAMES = sorted(TABLE_MAP.keys(), key=len, reverse=True)
-TABLE_RE = re.compile(
-    rf"""
-    \b(?P<name>{'|'.join(map(re.escape, TABLE_NAMES))})\b
+# Word boundaries as \b would see them: for ASCII this is exactly the ABAP
+# identifier class [A-Z0-9_], and non-ASCII letters still count as word chars
+_NOT_BEFORE_WORD = r"(?!\w)"
+
+_Trie = Dict[str, "_Trie"]
+
+def _trie_pattern(words: List[str]) -> str:
+    """
+    Build a prefix-factored alternation (e.g. MAR(?:C|D)H?) from literal words,
+    so the engine walks a trie instead of retrying every alternative per position.
+    The "not preceded by a word character" check is placed after each
+    first letter rather than in front, so re can still jump to candidate
+    first letters with its literal/charset prefix scan.
+    """
+    trie: _Trie = {}
+    for word in words:
+        node = trie
+        for ch in word:
+            node = node.setdefault(ch, {})
+        node[""] = {}
+
+    def emit(node: _Trie, first: bool = False) -> str:
+        alts = [
+            re.escape(ch) + (rf"(?<!\w{re.escape(ch)})" if first else "") + emit(child)
+            for ch, child in sorted(node.items()) if ch
+        ]
+        if not alts:
+            return ""
+        optional = "" in node
+        if len(alts) == 1 and not optional:
+            return alts[0]
+        body = "(?:" + "|".join(alts) + ")"
+        return body + "?" if optional else body
+
+    return emit(trie, first=True)
+
+# No length ordering needed: the word-boundary lookarounds only accept whole
+# names, so MARC can never match inside MARCH. That holds as long as every
+# key is a plain uppercase identifier.
+TABLE_NAMES = list(TABLE_MAP)
+assert all(re.fullmatch(r"[A-Z][A-Z0-9_]*", n) for n in TABLE_NAMES), "TABLE_MAP keys must be uppercase ABAP identifiers"
+_TABLE_ALT = _trie_pattern(TABLE_NAMES)
+
+TABLE_RE = re.compile(rf"(?P<name>{_TABLE_ALT}){_NOT_BEFORE_WORD}")
+
+# UPDATE/MODIFY/DELETE FROM at the start of a line: its target table is left
+# untouched. Matched in place at a line start; [^\S\n] keeps it on that line.
+GUARD_RE = re.compile(
+    rf"[^\S\n]*(?:UPDATE|MODIFY|DELETE[^\S\n]+FROM)[^\S\n]+(?P<name>{_TABLE_ALT}){_NOT_BEFORE_WORD}"
+)
+
+# Regex for SELECT … FROM … (capture field list before FROM)
+SELECT_RE = re.compile(
+    r"""
+    SELECT\s+(?P<fields>\*|.+?)\s+FROM\s+[A-Z0-9_]+.*?(?:\.|\n)
     """,
-    re.IGNORECASE | re.VERBOSE
+    re.IGNORECASE | re.VERBOSE | re.DOTALL
 )
 
+# TABLE_RE and GUARD_RE run on uppercased source. str.upper() can change the
+# length of non-ASCII text (e.g. "ß" -> "SS"), so only ASCII is folded then,
+# plus "ı"/"ſ", which case-insensitive matching treats as "I"/"S".
+_ASCII_UPPER = str.maketrans("abcdefghijklmnopqrstuvwxyzıſ", "ABCDEFGHIJKLMNOPQRSTUVWXYZIS")
+
+def _upper_same_length(txt: str) -> str:
+    return txt.upper() if txt.isascii() else txt.translate(_ASCII_UPPER)
+
 # -----------------------------
 # Models
 # -----------------------------
@@ -113,9 +174,49 @@ class Unit(BaseModel):
     # end_line: Optional[int] = None
     code: Optional[str] = ""
 
+class RemediatedUnit(Unit):
+    remediated_code: str
+
+@dataclass(frozen=True, slots=True)
+class Hit:
+    table: str
+    target_name: str
+    suggested_statement: str
+    snippet: str
+    note: Optional[str] = None
+
+    def as_dict(self) -> Dict[str, Any]:
+        """Expanded hit shape as reported by the API (mb_txn_usage)."""
+        meta: Dict[str, Any] = {
+            "table": self.table,
+            "target_type": "Table",
+            "target_name": self.target_name,
+            "used_fields": [],
+            "ambiguous": False,
+            "suggested_statement": self.suggested_statement,
+            "suggested_fields": None,
+            "snippet": self.snippet
+        }
+        if self.note:
+            meta["note"] = self.note
+        return meta
+
 # -----------------------------
 # Helpers
 # -----------------------------
+# --- CHANGE MARKER ---
+@lru_cache(maxsize=1)
+def _change_marker(day: int) -> str:
+    """Build the PwC comment once per calendar day (keyed by date ordinal)."""
+    today = date.fromordinal(day).strftime("%Y-%m-%d")
+    return f'\n" Changed by PwC on {today}\n'
+
+@lru_cache(maxsize=1)
+def _replacements(day: int) -> Dict[str, str]:
+    """Per-table replacement text (new name + PwC comment), shared by every hit that day."""
+    change_marker = _change_marker(day)
+    return {name: info["new"] + change_marker for name, info in TABLE_MAP.items()}
+
 # --- SNIPPET HELPER ---
 def snippet_at(text: str, start: int, end: int) -> str:
     s = max(0, start - 60)
@@ -123,29 +224,22 @@ def snippet_at(text: str, start: int, end: int) -> str:
     return text[s:e]
 
 def _add_hit(
-    hits: List[dict],
+    hits: List[Hit],
     span: Tuple[int, int],
     target_name: str,
     suggested_statement: str,
     src: str,
     note: Optional[str] = None
-):
+) -> None:
     start, end = span
-    meta = {
-        "table": target_name,
-        "target_type": "Table",
-        "target_name": target_name,
-        # "start_char_in_unit": span[0] if span else None,
-        # "end_char_in_unit": span[1] if span else None,
-        "used_fields": [],
-        "ambiguous": False,
-        "suggested_statement": suggested_statement,
-        "suggested_fields": None,
-        "snippet": snippet_at(src, start, end)
-    }
-    if note:
-        meta["note"] = note
-    hits.append(meta)
+    hits.append(Hit(
+        table=target_name,
+        target_name=target_name,
+        suggested_statement=suggested_statement,
+        # Sliced now so a Hit never keeps the whole unit source alive
+        snippet=snippet_at(src, start, end),
+        note=note or None
+    ))
 
 def add_order_by_to_selects(sql: str) -> str:
     """
@@ -153,7 +247,7 @@ def add_order_by_to_selects(sql: str) -> str:
     - For SELECT with explicit fields: ORDER BY those fields
     - For SELECT * : ORDER BY primary key placeholders (*)
     """
-    def replacer(match: re.Match) -> str:
+    def replacer(match: "re.Match[str]") -> str:
         full_stmt = match.group(0)
         fields = match.group("fields").strip()
 
@@ -176,17 +270,10 @@ def add_order_by_to_selects(sql: str) -> str:
         order_by = " ORDER BY " + " ".join(cleaned_fields)
         return full_stmt.rstrip(".") + order_by + "."
 
-    # Regex for SELECT … FROM … (capture field list before FROM)
-    select_re = re.compile(
-        r"""
-        SELECT\s+(?P<fields>\*|.+?)\s+FROM\s+[A-Z0-9_]+.*?(?:\.|\n)
-        """,
-        re.IGNORECASE | re.VERBOSE | re.DOTALL
-    )
-    return select_re.sub(replacer, sql)
+    return SELECT_RE.sub(replacer, sql)
 
 
-def remediate_code(txt: str) -> Tuple[str, List[dict]]:
+def remediate_code(txt: str) -> Tuple[str, List[Hit]]:
     """
     Replace obsolete MM-IM tables with S/4HANA replacements,
     but skip replacements if table is part of UPDATE/DELETE/MODIFY.
@@ -194,51 +281,93 @@ def remediate_code(txt: str) -> Tuple[str, List[dict]]:
     if not txt:
         return txt, []
 
-    issues: List[dict] = []
-    matches = sorted(TABLE_RE.finditer(txt), key=lambda x: x.start())
+    # Every table name starts with M: skip the regex scan when there is none
+    if "M" not in txt and "m" not in txt:
+        return txt, []
 
-    last_idx = 0
-    remediated_parts = []
+    return _remediate(txt, date.today().toordinal())
 
-    today = datetime.today().strftime("%Y-%m-%d")
-    change_marker = f'\n" Changed by PwC on {today}\n'
+# Result cache for remediate_text: only small units are cached, and only their
+# remediated text, so the cache stays bounded (~256 * 32K chars in + out)
+_CACHE_MAX_CHARS = 32 * 1024
 
-    for m in matches:
-        name = m.group("name").upper()
-        info = TABLE_MAP.get(name)
-        if not info:
-            continue
+def remediate_text(txt: str) -> str:
+    """
+    Same as remediate_code, but returns only the remediated source.
+    Identical small units (copy-pasted includes) are served from a cache.
+    """
+    if not txt or ("M" not in txt and "m" not in txt):
+        return txt
+
+    day = date.today().toordinal()
+    if len(txt) > _CACHE_MAX_CHARS:
+        return _remediate(txt, day, collect_hits=False)[0]
+    return _remediate_text_cached(txt, day)
+
+@lru_cache(maxsize=256)
+def _remediate_text_cached(txt: str, day: int) -> str:
+    return _remediate(txt, day, collect_hits=False)[0]
+
+def _remediate(txt: str, day: int, collect_hits: bool = True) -> Tuple[str, List[Hit]]:
+    """
+    Shared scan for remediate_code/remediate_text. With collect_hits=False
+    no Hit (snippet, suggested statement) is built; the returned list is empty.
+    """
+    issues: List[Hit] = []
+
+    replacements = _replacements(day)
+
+    # Uppercase once; match/guard on utxt, splice into the original txt
+    utxt = _upper_same_length(txt)
 
-        line_start = txt.rfind("\n", 0, m.start()) + 1
-        line_end = txt.find("\n", m.end())
-        if line_end == -1:
-            line_end = len(txt)
-        line = txt[line_start:line_end].upper()
+    edits: List[Tuple[int, int, str]] = []
+    # Guard decision is made once per line that has hits
+    guard_line = -1
+    guarded_name: Optional[str] = None
+    line_start = 0
+    prev_end = 0
+
+    for m in TABLE_RE.finditer(utxt):
+        name = m.group("name")
+        start, end = m.span()
 
         # --- Skip UPDATE/DELETE/MODIFY statements ---
-        if re.match(r"\s*(UPDATE|MODIFY)\s+" + name + r"\b", line) or re.match(r"\s*DELETE\s+FROM\s+" + name + r"\b", line):
-            remediated_parts.append(txt[last_idx:m.end()])
-            last_idx = m.end()
+        # Only scan back to the previous hit: no newline since then means the
+        # same line, so long lines with many hits stay linear
+        nl = utxt.rfind("\n", prev_end, start)
+        if nl != -1:
+            line_start = nl + 1
+        prev_end = end
+        if line_start != guard_line:
+            guard_line = line_start
+            g = GUARD_RE.match(utxt, line_start)
+            guarded_name = g.group("name") if g else None
+        if name == guarded_name:
             continue
 
-        # Normal replacement
-        replacement = info["new"]
-        remediated_parts.append(txt[last_idx:m.start()])
-        remediated_parts.append(replacement)
-        remediated_parts.append(change_marker)  # add PwC comment
-        last_idx = m.end()
+        # Normal replacement + PwC comment
+        edits.append((start, end, replacements[name]))
 
         # Track issue
-        _add_hit(
-            issues,
-            m.span(),
-            name,
-            f"Replaced {name} with {replacement}.",
-            src=txt,
-            note=info.get("note")
-        )
-
-    # Add trailing text
+        if collect_hits:
+            info = TABLE_MAP[name]
+            replacement = info["new"]
+            _add_hit(
+                issues,
+                (start, end),
+                name,
+                f"Replaced {name} with {replacement}.",
+                src=txt,
+                note=info.get("note")
+            )
+
+    # Splice accepted edits into the original text in one join
+    remediated_parts: List[str] = []
+    last_idx = 0
+    for start, end, replacement in edits:
+        remediated_parts.append(txt[last_idx:start])
+        remediated_parts.append(replacement)
+        last_idx = end
     remediated_parts.append(txt[last_idx:])
     new_txt = "".join(remediated_parts)
     # new_txt = add_order_by_to_selects(new_txt)
@@ -265,15 +394,20 @@ def remediate_code(txt: str) -> Tuple[str, List[dict]]:
 #         obj["remediated_code"] = remediated_src
 #         results.append(obj)
 #     return results
+
+def _process_unit(u: Unit) -> RemediatedUnit:
+    src = u.code or ""
+    remediated_src = remediate_text(src)
+
+    obj = u.model_dump()
+    obj["remediated_code"] = remediated_src
+    return RemediatedUnit(**obj)
+
 @app.post("/remediate-mm-im")
-async def remediate_mm_im(unit: Unit):
+async def remediate_mm_im(unit: Unit) -> RemediatedUnit:
         """
         Input: one ABAP unit with code.
         Output: single object with remediation.
         """
-        src = unit.code or ""
-        remediated_src, issues = remediate_code(src)
-
-        obj = json.loads(unit.model_dump_json())
-        obj["remediated_code"] = remediated_src
-        return obj    
+        # Regex scanning is CPU-bound; keep it off the event loop
+        return await asyncio.to_thread(_process_unit, unit)
@@ -0,0 +1,104 @@
+from datetime import date
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app.main import _change_marker, app, remediate_code, remediate_text
+
+MARKER = _change_marker(date.today().toordinal())
+
+
+def test_replaces_table_and_keeps_surrounding_case():
+    src = "select matnr from Marc into table lt_marc where werks = lv_werks."
+    new_txt, hits = remediate_code(src)
+    assert new_txt == (
+        "select matnr from NSDM_V_MARC" + MARKER
+        + " into table lt_marc where werks = lv_werks."
+    )
+    assert [h.table for h in hits] == ["MARC"]
+
+
+def test_skips_update_modify_delete_targets():
+    src = (
+        "UPDATE marc SET x = 1 WHERE marc~matnr = lv.\n"
+        "  modify MSEG from ls_mseg.\n"
+        "\tDELETE   FROM mkpf WHERE x = 1."
+    )
+    assert remediate_code(src) == (src, [])
+
+
+def test_guard_applies_only_at_line_start_and_to_the_target_table():
+    src = "x = 1. UPDATE marc SET y = 2.\nUPDATE mard SET f = marc."
+    new_txt, hits = remediate_code(src)
+    assert [h.table for h in hits] == ["MARC", "MARC"]
+    assert new_txt.count("NSDM_V_MARC") == 2
+    assert "UPDATE mard" in new_txt
+
+
+def test_word_boundaries():
+    src = "MARC_X XMARC MARCH marc1 ÄMARC ßmarc MARCé MARC-MATNR"
+    new_txt, hits = remediate_code(src)
+    assert [h.table for h in hits] == ["MARCH", "MARC"]
+    assert new_txt.startswith("MARC_X XMARC NSDM_V_MARCH" + MARKER)
+    assert new_txt.endswith("MARCé NSDM_V_MARC" + MARKER + "-MATNR")
+
+
+def test_remediate_text_matches_remediate_code():
+    src = "SELECT * FROM mseg.\nUPDATE mseg SET x = 1.\n" * 3
+    assert remediate_text(src) == remediate_code(src)[0]
+    assert remediate_text("WRITE lv.") == "WRITE lv."
+
+
+def test_hit_dict_shape():
+    _, hits = remediate_code("SELECT * FROM mkpf.")
+    meta = hits[0].as_dict()
+    assert meta == {
+        "table": "MKPF",
+        "target_type": "Table",
+        "target_name": "MKPF",
+        "used_fields": [],
+        "ambiguous": False,
+        "suggested_statement": "Replaced MKPF with MATDOC.",
+        "suggested_fields": None,
+        "snippet": "SELECT * FROM mkpf.",
+        "note": hits[0].note,
+    }
+
+
+def test_long_single_line_with_many_hits():
+    n = 20000
+    new_txt, hits = remediate_code("SELECT x FROM marc INTO y. " * n)
+    assert len(hits) == n
+    assert new_txt.count("NSDM_V_MARC" + MARKER) == n
+
+    guarded = "UPDATE marc SET a = marc." + " marc" * n + "\nmarc"
+    new_txt, hits = remediate_code(guarded)
+    assert len(hits) == 1
+    assert new_txt.endswith("\nNSDM_V_MARC" + MARKER)
+
+
+@pytest.mark.parametrize(
+    "code, expected_code, expected_remediated",
+    [
+        ("SELECT * FROM marc.", "SELECT * FROM marc.", "SELECT * FROM NSDM_V_MARC" + MARKER + "."),
+        (None, None, ""),
+        ("<missing>", "", ""),
+    ],
+)
+def test_endpoint_response(code, expected_code, expected_remediated):
+    unit = {"pgm_name": "ZPGM", "inc_name": "ZINC", "type": "PROG"}
+    if code != "<missing>":
+        unit["code"] = code
+
+    resp = TestClient(app).post("/remediate-mm-im", json=unit)
+
+    assert resp.status_code == 200
+    assert resp.json() == {
+        "pgm_name": "ZPGM",
+        "inc_name": "ZINC",
+        "type": "PROG",
+        "name": None,
+        "class_implementation": None,
+        "code": expected_code,
+        "remediated_code": expected_remediated,
+    }